@@ -1,19 +1,76 @@
-import numpy as np, pandas as pd, json, pathlib
+import numpy as np, numba, math, json, pathlib
+from datetime import datetime, timezone
 
 FEATS = pathlib.Path(__file__).with_name("fishing_classifier.features.txt").read_text().splitlines()
 
+# (sin, cos) of the hour-of-day, precomputed for all 24 hours
+_HOUR_SC = np.array([[np.sin(2*np.pi*h/24), np.cos(2*np.pi*h/24)] for h in range(24)])
+
+def _utc_hour(start: str) -> int:
+    # GFW `start` is ISO-8601, e.g. "2024-05-01T13:20:00.000Z"
+    ts = datetime.fromisoformat(start)
+    if ts.tzinfo is not None:
+        ts = ts.astimezone(timezone.utc)
+    return ts.hour
+
 def vectorize(e: dict) -> np.ndarray:
     # Event JSON comes from GFW `/v3/events`
-    ts = pd.to_datetime(e["timestamp"], unit="s", utc=True)
+    sin_h, cos_h = _HOUR_SC[_utc_hour(e["start"])]
     v  = [
         e.get("speed", 0.0),
         e.get("course", 0.0),
         e.get("distance_from_shore", 1e6),
         e.get("distance_from_port", 1e6),
-        np.sin(2*np.pi*ts.hour/24),
-        np.cos(2*np.pi*ts.hour/24),
-        np.floor(e["lat"]/0.25)*0.25,
-        np.floor(e["lon"]/0.25)*0.25,
-        "unknown",          # gear_type placeholder (categorical)
+        sin_h,
+        cos_h,
+        np.floor(e["position"]["lat"]/0.25)*0.25,
+        np.floor(e["position"]["lon"]/0.25)*0.25,
+        np.nan,             # gear_type unknown → missing
     ]
-    return np.array(v, dtype=object)    # ONNX mixed types
+    return np.asarray(v, dtype=np.float32)
+
+
+@numba.njit(cache=True, parallel=True)   # no fastmath: gear_type is written as NaN
+def _build(speed, course, dshore, dport, lat, lon, hour, hour_sc, out):
+    # one fused pass over the rows, straight into `out`
+    for i in numba.prange(speed.shape[0]):
+        h = hour[i]
+        out[i, 0] = speed[i]
+        out[i, 1] = course[i]
+        out[i, 2] = dshore[i]
+        out[i, 3] = dport[i]
+        out[i, 4] = hour_sc[h, 0]
+        out[i, 5] = hour_sc[h, 1]
+        out[i, 6] = math.floor(lat[i]/0.25)*0.25
+        out[i, 7] = math.floor(lon[i]/0.25)*0.25
+        out[i, 8] = np.nan          # gear_type unknown → missing
+
+
+def vectorize_batch(evs: list[dict], out: np.ndarray | None = None) -> np.ndarray:
+    # Column-wise version of `vectorize` → contiguous (N, F) float32.
+    # Pass a preallocated (>=N, F) float32 `out` to reuse it across calls.
+    n = len(evs)
+    if out is None:
+        out = np.empty((n, len(FEATS)), dtype=np.float32)
+    # _build is unchecked numba code: a bad buffer would write out of bounds
+    elif (out.dtype != np.float32 or out.ndim != 2
+          or out.shape[0] < n or out.shape[1] != len(FEATS)):
+        raise ValueError(f"out must be float32 (>={n}, {len(FEATS)}), "
+                         f"got {out.dtype} {out.shape}")
+    col = lambda k, d: np.fromiter((e.get(k, d) for e in evs), dtype=np.float64, count=n)
+    _build(
+        col("speed", 0.0),
+        col("course", 0.0),
+        col("distance_from_shore", 1e6),
+        col("distance_from_port", 1e6),
+        np.fromiter((e["position"]["lat"] for e in evs), dtype=np.float64, count=n),
+        np.fromiter((e["position"]["lon"] for e in evs), dtype=np.float64, count=n),
+        np.fromiter((_utc_hour(e["start"]) for e in evs), dtype=np.int64, count=n),
+        _HOUR_SC,
+        out,
+    )
+    return out[:n]
+
+
+# compile (or load from cache) now rather than on the first poll
+vectorize_batch([{"start": "1970-01-01T00:00:00Z", "position": {"lat": 0.0, "lon": 0.0}}])
@@ -1,29 +1,145 @@
 from fastapi import FastAPI, WebSocket
 from fastapi.middleware.cors import CORSMiddleware
+from contextlib import asynccontextmanager, suppress
 from dotenv import load_dotenv
 from supabase import create_client
-import os, asyncio, json
+import os, asyncio, orjson, itertools, websockets
 
 load_dotenv()
-SUPA = create_client(os.environ["SUPABASE_URL"],
-                     os.environ["SUPABASE_ANON_KEY"])
+SUPA_URL, SUPA_KEY = os.environ["SUPABASE_URL"], os.environ["SUPABASE_ANON_KEY"]
+SUPA = create_client(SUPA_URL, SUPA_KEY)
 
-app = FastAPI()
+REALTIME_URL = (SUPA_URL.replace("http", "ws", 1)
+                + f"/realtime/v1/websocket?apikey={SUPA_KEY}&vsn=1.0.0")
+SUBSCRIBERS: dict[asyncio.Queue, asyncio.Task] = {}   # /ws client queue → its handler task
+WS_QUEUE_MAX = 1000                        # rows buffered per client before it is dropped
+MAX_ID: int | None = None                  # newest alert id seen by the feed; None until known
+
+
+def fetch_since(last: int, limit=100) -> list[dict]:
+    return (SUPA.table("iuu_alerts")
+               .select("*")
+               .gt("id", last)
+               .order("id")
+               .limit(limit)
+               .execute()).data
+
+
+def latest_id() -> int:
+    rows = (SUPA.table("iuu_alerts")
+               .select("id")
+               .order("id", desc=True)
+               .limit(1)
+               .execute()).data
+    return rows[0]["id"] if rows else 0
+
+
+def _broadcast(row: dict):
+    global MAX_ID
+    MAX_ID = max(MAX_ID or 0, row["id"])
+    for q, task in list(SUBSCRIBERS.items()):
+        try:
+            q.put_nowait(row)
+        except asyncio.QueueFull:
+            # client stopped reading: drop it, it reconnects and catches up by id
+            del SUBSCRIBERS[q]
+            task.cancel()
+
+
+async def _heartbeat(rt, ref):
+    while True:
+        await asyncio.sleep(25)
+        await rt.send(orjson.dumps({"topic": "phoenix", "event": "heartbeat",
+                                    "payload": {}, "ref": str(next(ref))}).decode())
+
+
+async def _realtime_feed():
+    # one Realtime subscription per process, fanned out to every client
+    ref  = itertools.count(1)
+    join = {"topic": "realtime:iuu_alerts", "event": "phx_join",
+            "payload": {"config": {"postgres_changes": [
+                {"event": "INSERT", "schema": "public", "table": "iuu_alerts"}
+            ]}}}
+    global MAX_ID
+    last = None
+    while True:
+        try:
+            if last is None:
+                # seed inside the retry so a Supabase hiccup at start isn't fatal
+                last = MAX_ID = await asyncio.to_thread(latest_id)
+
+            async with websockets.connect(REALTIME_URL) as rt:
+                join_ref = str(next(ref))
+                await rt.send(orjson.dumps({**join, "ref": join_ref}).decode())
+                hb = asyncio.create_task(_heartbeat(rt, ref))
+                try:
+                    # replay anything inserted while we were (re)connecting
+                    while rows := await asyncio.to_thread(fetch_since, last):
+                        for r in rows:
+                            _broadcast(r)
+                            last = r["id"]
+
+                    async for raw in rt:
+                        msg = orjson.loads(raw)
+                        ev, payload = msg["event"], msg.get("payload") or {}
+                        # a rejected join (e.g. table not in the publication) or a
+                        # channel error must not look like an idle feed
+                        if ((ev == "phx_reply" and msg.get("ref") == join_ref
+                                and payload.get("status") != "ok")
+                                or (ev == "system" and payload.get("status") == "error")
+                                or (ev in ("phx_error", "phx_close")
+                                    and msg.get("topic") == join["topic"])):
+                            raise RuntimeError(f"realtime {ev}: {payload}")
+                        if ev != "postgres_changes":
+                            continue
+                        r = payload["data"]["record"]
+                        _broadcast(r)
+                        last = max(last, r["id"])
+                finally:
+                    hb.cancel()
+        except Exception as e:
+            print(f"realtime feed dropped: {e!r}")
+        await asyncio.sleep(5)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    feed = asyncio.create_task(_realtime_feed())
+    yield
+    feed.cancel()
+
+
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(CORSMiddleware, allow_origins=["*"],
                    allow_methods=["*"], allow_headers=["*"])
 
 @app.websocket("/ws")
 async def ws_alerts(ws: WebSocket):
     await ws.accept()
-    last = 0
-    while True:
-        rows = (SUPA.table("iuu_alerts")
-                   .select("*")
-                   .gt("id", last)
-                   .order("id")
-                   .limit(100)
-                   .execute()).data
-        for r in rows:
-            await ws.send_text(json.dumps(r))
+    q: asyncio.Queue = asyncio.Queue(maxsize=WS_QUEUE_MAX)
+    SUBSCRIBERS[q] = asyncio.current_task()   # subscribe first so nothing slips past the catch-up
+    try:
+        last = 0
+        # one-off catch-up, then rows are pushed as they are inserted;
+        # skip the query once we've reached the newest id the feed knows of
+        while MAX_ID is None or last < MAX_ID:
+            rows = await asyncio.to_thread(fetch_since, last)
+            for r in rows:
+                await ws.send_text(orjson.dumps(r).decode())
+                last = r["id"]
+            if len(rows) < 100:
+                break
+        while True:
+            r = await q.get()
+            if r["id"] <= last:
+                continue
+            await ws.send_text(orjson.dumps(r).decode())
             last = r["id"]
-        await asyncio.sleep(5)
+    except asyncio.CancelledError:
+        if q in SUBSCRIBERS:
+            raise                        # server shutdown, not a slow-client drop
+        asyncio.current_task().uncancel()
+        with suppress(Exception):
+            await asyncio.wait_for(ws.close(code=1013), 5)   # 1013: try again later
+    finally:
+        SUBSCRIBERS.pop(q, None)
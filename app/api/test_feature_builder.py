@@ -0,0 +1,36 @@
+import numpy as np, pytest
+from feature_builder import FEATS, vectorize, vectorize_batch
+
+# trimmed GFW /v3/events entry, same shape the worker feeds in
+GFW_ENTRY = {
+    "start": "2024-05-01T13:20:00.000Z",
+    "end":   "2024-05-01T15:05:00.000Z",
+    "id":    "9b3e9019d1e7fd2c7e59b7d3b6c9e2b1",
+    "type":  "fishing",
+    "position": {"lat": 24.61, "lon": 52.37},
+    "vessel":   {"id": "c4d0e5c1f-f98f-1a2b", "ssvid": "470123456", "name": "EXAMPLE"},
+}
+
+
+def test_vectorize_batch_reads_gfw_entry():
+    X = vectorize_batch([GFW_ENTRY, {**GFW_ENTRY, "start": "2024-05-01T17:20:00+04:00"}])
+    assert X.shape == (2, len(FEATS)) and X.dtype == np.float32
+    h = 2*np.pi*13/24
+    np.testing.assert_allclose(X[0, :8], [0.0, 0.0, 1e6, 1e6, np.sin(h), np.cos(h), 24.5, 52.25], rtol=1e-6)
+    np.testing.assert_array_equal(X[0], X[1])       # same instant, different offset
+    assert np.isnan(X[0, 8])
+
+
+def test_vectorize_matches_batch():
+    np.testing.assert_array_equal(vectorize(GFW_ENTRY), vectorize_batch([GFW_ENTRY])[0])
+
+
+@pytest.mark.parametrize("out", [
+    np.empty((4, len(FEATS)), np.float32)[:1],      # too few rows
+    np.empty((3, len(FEATS) - 1), np.float32),      # too narrow
+    np.empty((3, len(FEATS)), np.float64),          # wrong dtype
+    np.empty(3 * len(FEATS), np.float32),           # not 2-D
+])
+def test_vectorize_batch_rejects_bad_out(out):
+    with pytest.raises(ValueError):
+        vectorize_batch([GFW_ENTRY] * 3, out=out)
@@ -1,12 +1,14 @@
-# apps/api/worker.py  –  Poll GFW GET /v3/events ✅
+# app/api/worker.py  –  Poll GFW GET /v3/events ✅
 
-import os, ssl, certifi, asyncio, aiohttp, socket
+import os, ssl, certifi, asyncio, aiohttp, socket, pathlib, orjson, random
+import numpy as np
 from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
-from shapely.geometry import shape, Point
+import shapely, shapely.wkb
+from shapely.geometry import shape
 import onnxruntime as ort
 from supabase import create_client
-from feature_builder import vectorize
+from feature_builder import FEATS, vectorize_batch
 
 load_dotenv()
 
@@ -19,22 +21,187 @@ SUPA    = create_client(
     os.environ["SUPABASE_SERVICE_KEY"]
 )
 
-sess = ort.InferenceSession("fishing_classifier.onnx")
-inp, out = sess.get_inputs()[0].name, sess.get_outputs()[0].name
+MODEL     = "fishing_classifier.onnx"
+MODEL_OPT = "fishing_classifier.opt.onnx"   # ORT-optimised copy, written on first start
+
+so = ort.SessionOptions()
+so.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+so.execution_mode           = ort.ExecutionMode.ORT_SEQUENTIAL
+so.intra_op_num_threads     = int(os.getenv("ORT_THREADS", os.cpu_count() or 1))
+so.enable_cpu_mem_arena     = True
+if os.path.exists(MODEL_OPT) and os.path.getmtime(MODEL_OPT) >= os.path.getmtime(MODEL):
+    model = MODEL_OPT
+else:
+    model = MODEL
+    so.optimized_model_filepath = MODEL_OPT
+# TreeEnsembleClassifier only has a CPU kernel, so a GPU EP would just add copies
+sess = ort.InferenceSession(model, sess_options=so, providers=["CPUExecutionProvider"])
+inp, out = sess.get_inputs()[0].name, sess.get_outputs()[1].name  # probabilities
 THR = 0.60
 
+# input/output buffers reused across windows, bound zero-copy via IOBinding
+io = sess.io_binding()
+_X = np.empty((1024, len(FEATS)), dtype=np.float32)
+_P = np.empty((1024, 2), dtype=np.float32)
+
+# adaptive batching: flush after INFER_BATCH rows or INFER_WAIT s, whichever first
+INFER_Q: asyncio.Queue[tuple[list[dict], asyncio.Future]] = asyncio.Queue()
+INFER_BATCH = 4096
+INFER_WAIT  = 0.05
+
+# optional rules for easy negatives, checked before inference. Off unless the
+# env var is set: only enable a cut once it has been checked against the
+# model's tree thresholds or labelled data. Only reported values are tested;
+# events missing a field still go to the model.
+def _env_float(k, default=None, lo=0.0, hi=float("inf")):
+    # fail at startup, not on the first window, if a setting is out of range
+    if not os.getenv(k):
+        return default
+    v = float(os.environ[k])
+    if not lo <= v <= hi:
+        raise ValueError(f"{k}={v} must be within [{lo}, {hi}]")
+    return v
+
+PRE_MAX_SPEED = _env_float("PRE_MAX_SPEED")               # knots
+PRE_MIN_PORT  = _env_float("PRE_MIN_PORT")                # m
+PRE_AUDIT     = _env_float("PRE_AUDIT", 0.05, hi=1.0)     # share of rejects scored for logging only
+
 API_BASE = "https://gateway.api.globalfishingwatch.org"
+GFW_CONCURRENCY = 4   # max concurrent /v3/events page requests
 EEZ = None  # only needed if you still want spatial filtering
+EEZ_CACHE = (pathlib.Path(__file__).with_name(f"eez_{os.getenv('MRGID')}.wkb")
+             if os.getenv("MRGID") else None)   # no cache without an MRGID to key it
+_SESSION: aiohttp.ClientSession | None = None
+
+LICENCES: frozenset[str] = frozenset()   # licensed MMSIs, refreshed in background
+LICENCE_REFRESH = 600                    # seconds
 
 
 # ──────────────────────────────────────────────────────────────
 # Helpers
 # ──────────────────────────────────────────────────────────────
+async def _get_session() -> aiohttp.ClientSession:
+    # one pooled keep-alive session for the life of the worker
+    global _SESSION
+    if _SESSION is None or _SESSION.closed:
+        _SESSION = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                ssl=ssl_ctx, family=socket.AF_INET,
+                limit=32, keepalive_timeout=300,
+            )
+        )
+    return _SESSION
+
+
+async def _close_session():
+    if _SESSION is not None and not _SESSION.closed:
+        await _SESSION.close()
+
+
+def load_licences(page=1000) -> frozenset[str]:
+    # PostgREST caps each select (max-rows may be < page), so walk a stable
+    # order until a page comes back empty
+    mmsis = []
+    while True:
+        rows = SUPA.table("licences")\
+                   .select("mmsi")\
+                   .order("mmsi")\
+                   .range(len(mmsis), len(mmsis) + page - 1)\
+                   .execute().data
+        if not rows:
+            return frozenset(mmsis)
+        mmsis += [str(r["mmsi"]) for r in rows]
+
+
+async def _refresh_licences():
+    global LICENCES
+    while True:
+        await asyncio.sleep(LICENCE_REFRESH)
+        try:
+            LICENCES = await asyncio.to_thread(load_licences)
+        except Exception as e:
+            print(f"[{datetime.now()}] licence refresh failed: {e}")
+
+
+def prefilter(evs: list[dict]) -> np.ndarray:
+    # True where the event still needs scoring
+    n = len(evs)
+    keep = np.ones(n, dtype=bool)
+    col = lambda k: np.fromiter((e.get(k, np.nan) for e in evs), dtype=np.float64, count=n)
+    if PRE_MAX_SPEED is not None:
+        keep &= ~(col("speed") >= PRE_MAX_SPEED)
+    if PRE_MIN_PORT is not None:
+        keep &= ~(col("distance_from_port") <= PRE_MIN_PORT)
+    return keep
+
+
+def predict(evs: list[dict]) -> np.ndarray:
+    # P(fishing) per event; the result is a view valid until the next call
+    global _X, _P
+    n = len(evs)
+    if n > len(_X):
+        rows = max(n, 2*len(_X))
+        _X = np.empty((rows, len(FEATS)), dtype=np.float32)
+        _P = np.empty((rows, 2), dtype=np.float32)
+    vectorize_batch(evs, out=_X)
+    io.bind_input(inp, "cpu", 0, np.float32, [n, len(FEATS)], _X.ctypes.data)
+    io.bind_output(out, "cpu", 0, np.float32, [n, 2], _P.ctypes.data)
+    sess.run_with_iobinding(io)
+    return _P[:n, 1]
+
+
+async def _infer_worker():
+    # sole caller of predict(), so the shared buffers never race
+    loop = asyncio.get_running_loop()
+    while True:
+        reqs = [await INFER_Q.get()]
+        rows = len(reqs[0][0])
+        deadline = loop.time() + INFER_WAIT
+        while rows < INFER_BATCH:
+            try:
+                reqs.append(await asyncio.wait_for(INFER_Q.get(), max(0, deadline - loop.time())))
+            except asyncio.TimeoutError:
+                break
+            rows += len(reqs[-1][0])
+
+        evs = [ev for r, _ in reqs for ev in r]
+        try:
+            probs = await asyncio.to_thread(lambda: predict(evs).copy())
+        except Exception as e:
+            for _, fut in reqs:
+                if not fut.done():
+                    fut.set_exception(e)
+            continue
+
+        i = 0
+        for r, fut in reqs:
+            if not fut.done():
+                fut.set_result(probs[i:i + len(r)])
+            i += len(r)
+
+
+async def infer(evs: list[dict]) -> np.ndarray:
+    # queue a batch of events for the shared classifier, await their probabilities
+    fut = asyncio.get_running_loop().create_future()
+    await INFER_Q.put((evs, fut))
+    return await fut
+
+
 async def get_eez_polygon():
+    # returns a prepared geometry; parsed WFS result is cached on disk as WKB
     global EEZ
     if EEZ:
         return EEZ
 
+    if EEZ_CACHE and EEZ_CACHE.exists():
+        try:
+            EEZ = shapely.wkb.loads(EEZ_CACHE.read_bytes())
+            shapely.prepare(EEZ)
+            return EEZ
+        except Exception as e:
+            # unreadable cache (e.g. truncated write): fall back to the WFS
+            print(f"[{datetime.now()}] ignoring bad EEZ cache {EEZ_CACHE}: {e}")
+
     url = "https://geo.vliz.be/geoserver/wfs"
     params = {
         "service":      "WFS",
@@ -49,13 +216,18 @@ async def get_eez_polygon():
             f"</PropertyIsEqualTo></Filter>"
         )
     }
-    async with aiohttp.ClientSession(
-        connector=aiohttp.TCPConnector(ssl=ssl_ctx, family=socket.AF_INET)
-    ) as s:
-        async with s.get(url, params=params) as r:
-            r.raise_for_status()
-            geo = (await r.json())["features"][0]["geometry"]
-            EEZ = shape(geo)
+    s = await _get_session()
+    async with s.get(url, params=params) as r:
+        r.raise_for_status()
+        geo = orjson.loads(await r.read())["features"][0]["geometry"]
+        geom = shape(geo)
+    if EEZ_CACHE:
+        # write-then-rename so a crash never leaves a truncated cache behind
+        tmp = EEZ_CACHE.with_suffix(".wkb.tmp")
+        tmp.write_bytes(shapely.wkb.dumps(geom))
+        os.replace(tmp, EEZ_CACHE)
+    shapely.prepare(geom)
+    EEZ = geom
     return EEZ
 
 
@@ -75,17 +247,40 @@ async def fetch_events(since: datetime, limit=5000, offset=0):
     }
     headers = {
         "Authorization": f"Bearer {os.getenv('GFW_TOKEN')}",
-        "Accept":        "application/json",
+        "Accept":          "application/json",
+        "Accept-Encoding": "gzip, deflate, br",   # br decoding via aiohttp[speedups]
     }
 
-    async with aiohttp.ClientSession(
-        connector=aiohttp.TCPConnector(ssl=ssl_ctx, family=socket.AF_INET)
-    ) as s:
-        async with s.get(url, params=params, headers=headers) as r:
-            if r.status >= 300:
-                text = await r.text()
-                raise RuntimeError(f"GFW {r.status}: {text}")
-            return await r.json()
+    s = await _get_session()
+    async with s.get(url, params=params, headers=headers) as r:
+        if r.status >= 300:
+            text = await r.text()
+            raise RuntimeError(f"GFW {r.status}: {text}")
+        return orjson.loads(await r.read())
+
+
+async def fetch_all_events(since: datetime, limit=5000):
+    """
+    Page 0 tells us `total`; the remaining pages are fetched concurrently
+    (at most GFW_CONCURRENCY in flight) over the pooled session, merged,
+    and de-duplicated on event id in case the result set shifted between pages.
+    """
+    payload = await fetch_events(since, limit=limit)
+    gate = asyncio.Semaphore(GFW_CONCURRENCY)
+
+    async def page(offset):
+        async with gate:
+            return await fetch_events(since, limit=limit, offset=offset)
+
+    pages = await asyncio.gather(*[
+        page(o) for o in range(limit, payload["total"], limit)
+    ])
+    entries = {}
+    for p in [payload, *pages]:
+        for ev in p["entries"]:
+            entries.setdefault(ev["id"], ev)
+    payload["entries"] = list(entries.values())
+    return payload
 
 
 # ──────────────────────────────────────────────────────────────
@@ -95,43 +290,72 @@ async def main():
     # optional: load EEZ if you still want to spatial-filter
     eez = await get_eez_polygon()
 
+    global LICENCES
+    LICENCES = await asyncio.to_thread(load_licences)
+    refresher = asyncio.create_task(_refresh_licences())  # keep a ref so it isn't GC'd
+    inferrer  = asyncio.create_task(_infer_worker())
+
     while True:
         since  = datetime.now(timezone.utc) - timedelta(minutes=15)
-        payload = await fetch_events(since)
+        payload = await fetch_all_events(since)
         print(f"[{datetime.now()}] fetched {payload['total']} events")
 
-        for ev in payload.get("entries", []):
-            lon = ev["position"]["lon"]
-            lat = ev["position"]["lat"]
-
-            # example spatial filter; remove if you want *all* events
-            if not eez.contains(Point(lon, lat)):
-                continue
-
-            ssvid = ev["vessel"]["ssvid"]
-            # skip already‐licensed
-            exists = SUPA.table("licences")\
-                        .select("mmsi")\
-                        .eq("mmsi", ssvid)\
-                        .execute().data
-            if exists:
-                continue
-
-            prob = float(sess.run([out], {inp: vectorize(ev)[None, :]})[0][0][0])
-            if prob < THR:
-                continue
-
-            SUPA.table("iuu_alerts").insert({
-                "mmsi": ssvid,
-                "ts":   ev["start"],
-                "lat":  lat,
-                "lon":  lon,
+        # pass 1: spatial + licence filter
+        entries = payload.get("entries", [])
+        lons = np.fromiter((e["position"]["lon"] for e in entries), dtype=np.float64, count=len(entries))
+        lats = np.fromiter((e["position"]["lat"] for e in entries), dtype=np.float64, count=len(entries))
+
+        # example spatial filter; remove if you want *all* events
+        inside = shapely.contains_xy(eez, lons, lats)
+
+        candidates = [
+            ev for ev, keep in zip(entries, inside)
+            if keep and str(ev["vessel"]["ssvid"]) not in LICENCES   # skip already‐licensed
+        ]
+
+        # drop easy negatives; a random sample of them is scored for logging only
+        keep     = prefilter(candidates)
+        kept     = [ev for ev, k in zip(candidates, keep) if k]
+        rejected = [ev for ev, k in zip(candidates, keep) if not k]
+        audit    = random.sample(rejected, int(len(rejected) * PRE_AUDIT))
+        scored   = kept + audit
+
+        # pass 2: one batched inference call for the whole window
+        if scored:
+            probs = await infer(scored)
+
+            if rejected:
+                missed = int((probs[len(kept):] >= THR).sum())
+                print(f"[{datetime.now()}] prefilter dropped {len(rejected)}/{len(candidates)}; "
+                      f"{missed}/{len(audit)} audited would have alerted")
+
+            # only kept rows alert, so an alert never depends on the audit draw;
+            # ev["start"] is already an ISO-8601 string from GFW
+            hits = np.flatnonzero(probs[:len(kept)] >= THR)
+            alerts = [{
+                "mmsi": kept[i]["vessel"]["ssvid"],
+                "ts":   kept[i]["start"],
+                "lat":  kept[i]["position"]["lat"],
+                "lon":  kept[i]["position"]["lon"],
                 "prob": prob
-            }).execute()
+            } for i, prob in zip(hits.tolist(), probs[hits].tolist())]
+
+            # single bulk insert, off the event loop
+            if alerts:
+                await asyncio.to_thread(
+                    lambda: SUPA.table("iuu_alerts").insert(alerts).execute()
+                )
 
         # sleep before fetching the next window
         await asyncio.sleep(600)
 
 
+async def run():
+    try:
+        await main()
+    finally:
+        await _close_session()
+
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    asyncio.run(run())